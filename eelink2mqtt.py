@@ -1,14 +1,96 @@
 #!/usr/bin/env -S python3
 import socket
 import struct
+import selectors
 import threading
+import queue
 import time
 import json
 import argparse
-from datetime import datetime
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, Optional, Tuple
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Precompiled packet layouts (big-endian)
+_U16_S = struct.Struct('>H')
+_HEADER_S = struct.Struct('>HBH')  # marks, cmd, size
+_LOGIN_ACK_S = struct.Struct('>BBBHHIHB')
+# status, battery, ain0, ain1, mileage, gsm_cntr, gps_cntr, pdm_step, pdm_time,
+# temperature, humidity, illuminance, co2
+_TAIL_S = struct.Struct('>HHHHIHHHHHHII')
+
+# Linux only; the kernel clears it again, so it is re-armed after every read
+_TCP_QUICKACK = getattr(socket, 'TCP_QUICKACK', None)
+
+# Fixed-point scale factors. Coordinates are divided by a precomputed
+# divisor because the reciprocal is not exact and would change the results;
+# 1/256 is exact, so temperature can be multiplied
+_LAT_DIV = 162000000 / 90.0
+_LON_DIV = 324000000 / 180.0
+_TEMP_SCALE = 1.0 / 256.0
+
+# Optional POSITION sections in wire order:
+# (mask bit, struct format, field names, position dict entries)
+_POSITION_SECTIONS = (
+    (0x01, 'iihHHB', 'lat, lon, alt, speed, course, sats',
+     '"latitude": lat / _LAT_DIV, "longitude": lon / _LON_DIV, "altitude_m": alt, '
+     '"speed_kmh": speed, "course_deg": course, "satellites": sats'),
+    (0x02, 'HHHIB', 'mcc, mnc, lac0, cid, rxlev0',
+     '"bsid0": {"mcc": mcc, "mnc": mnc, "lac": lac0, "cid": cid, "rxlev": rxlev0}'),
+    (0x04, 'HIB', 'lac1, ci1, rxlev1',
+     '"bsid1": {"lac": lac1, "ci": ci1, "rxlev": rxlev1}'),
+    (0x08, 'HIB', 'lac2, ci2, rxlev2',
+     '"bsid2": {"lac": lac2, "ci": ci2, "rxlev": rxlev2}'),
+    (0x10, '6sb', 'bssid0, rssi0',
+     '"bss0": {"bssid": bssid0.hex(":"), "rssi": rssi0}'),
+    (0x20, '6sb', 'bssid1, rssi1',
+     '"bss1": {"bssid": bssid1.hex(":"), "rssi": rssi1}'),
+    (0x40, '6sb', 'bssid2, rssi2',
+     '"bss2": {"bssid": bssid2.hex(":"), "rssi": rssi2}'),
+)
+
+
+def _compile_position_parser(mask: int, format_date: Callable[[int], str]) -> Callable:
+    """Generate a POSITION parser specialized for one mask value.
+
+    The returned function takes the POSITION bytes and returns the position
+    dict and its size, with a single unpack and no per-section branching.
+    """
+    sections = [section for section in _POSITION_SECTIONS if mask & section[0]]
+    layout = struct.Struct('>IB' + ''.join(section[1] for section in sections))
+    names = ', '.join(['timestamp', 'mask'] + [section[2] for section in sections])
+    entries = ', '.join(['"time": timestamp', '"date": format_date(timestamp)'] + [section[3] for section in sections])
+    source = (
+        "def parse(data):\n"
+        f"    {names} = unpack_from(data)\n"
+        f"    return {{{entries}}}, {layout.size}\n"
+    )
+    
+    namespace = {
+        "unpack_from": layout.unpack_from,
+        "format_date": format_date,
+        "_LAT_DIV": _LAT_DIV,
+        "_LON_DIV": _LON_DIV,
+    }
+    exec(source, namespace)
+    return namespace["parse"]
+
+
+# MQTT payload serializer (returns bytes); orjson is used when available
+if orjson is not None:
+    def _dumps(data: Dict) -> bytes:
+        return orjson.dumps(data, default=str)
+else:
+    _json_encode = json.JSONEncoder(separators=(',', ':'), default=str).encode
+
+    def _dumps(data: Dict) -> bytes:
+        return _json_encode(data).encode()
+
 
 class EelinkV2Server:
     """Server for handling Eelink V2.0 protocol GPS tracker connections."""
@@ -16,6 +98,10 @@ class EelinkV2Server:
     # Protocol constants
     HEADER_MARK1 = 0x67
     HEADER_MARK2 = 0x67
+    HEADER_MARKS = HEADER_MARK1 << 8 | HEADER_MARK2
+    HEADER_MARKS_BYTES = bytes((HEADER_MARK1, HEADER_MARK2))
+    # Standard ACK: marks, cmd, size=2, seq; cmd and seq are patched in place
+    ACK_TEMPLATE = bytes((HEADER_MARK1, HEADER_MARK2, 0, 0, 2, 0, 0))
     CMD_LOGIN = 0x01
     CMD_HEARTBEAT = 0x03
     CMD_LOCATION = 0x12
@@ -26,131 +112,337 @@ class EelinkV2Server:
     MQTT_USER = "mosquitto"
     MQTT_PASS = "mosquitto"
     MQTT_TOPIC_PREFIX = "eelink"
+    MQTT_QUEUE_SIZE = 1000
+    MQTT_MAX_INFLIGHT = 64
+    MQTT_RECONNECT_MIN_DELAY = 1
+    MQTT_RECONNECT_MAX_DELAY = 120
+    MQTT_STOP_TIMEOUT = 5
+    
+    # Per-connection receive buffer size
+    RECV_BUFFER_SIZE = 8192
+    # Kernel socket buffer sizes, sized for bursts of stored records after a reconnect
+    SOCKET_RCVBUF = 262144
+    SOCKET_SNDBUF = 65536
+    
+    # Device status bits: bit -> (set message, cleared message)
+    STATUS_BITS = {
+        0: ("GPS fixed", "GPS NOT fixed"),
+        1: ("Car device", "NOT car device"),
+        2: ("Engine fired", "Engine NOT fired"),
+        3: ("Accelerometer supported", "No accelerometer"),
+        4: ("Motion-warning active", "Motion-warning inactive"),
+        5: ("Relay control supported", "No relay control"),
+        6: ("Relay triggered", "Relay NOT triggered"),
+        7: ("External charging supported", "No external charging"),
+        8: ("Charging", "NOT charging"),
+        9: ("Device active", "Device stationary"),
+        10: ("GPS module running", "GPS module NOT running"),
+        11: ("OBD module running", "OBD module NOT running"),
+        12: ("DIN0 HIGH", "DIN0 LOW"),
+        13: ("DIN1 HIGH", "DIN1 LOW"),
+        14: ("DIN2 HIGH", "DIN2 LOW"),
+        15: ("DIN3 HIGH", "DIN3 LOW"),
+    }
+    _STATUS_PAIRS = tuple(pair for _, pair in sorted(STATUS_BITS.items()))
     
     def __init__(self, host: str = '0.0.0.0', port: int = 5064, verbose: bool=False):
         self.host = host
         self.port = port
         self.verbose = verbose
         self.server_socket = None
+        self.selector = None
         self.running = False
         self.mqtt_client = None
+        self._publisher_thread = None
+        self._pub_q = queue.Queue(maxsize=self.MQTT_QUEUE_SIZE)
+        self._topic_cache = {}
+        self._last_ts = None
+        self._last_date = ''
+        self._parsers = {}
+        
+        # Command dispatch; handlers return the device IMEI for the connection
+        self._handlers = {
+            self.CMD_LOGIN: self._handle_login,
+            self.CMD_HEARTBEAT: self._handle_heartbeat,
+            self.CMD_LOCATION: self._handle_location,
+        }
+        
         self._setup_mqtt()
     
     def _setup_mqtt(self):
-        """Initialize MQTT client connection."""
-        self.mqtt_client = mqtt.Client()
+        """Initialize MQTT client connection and the publisher thread."""
+        self.mqtt_client = mqtt.Client(protocol=mqtt.MQTTv5, transport='tcp')
         self.mqtt_client.username_pw_set(self.MQTT_USER, self.MQTT_PASS)
+        self.mqtt_client.max_inflight_messages_set(self.MQTT_MAX_INFLIGHT)
+        # paho's network loop retries (re)connections with exponential backoff
+        self.mqtt_client.reconnect_delay_set(self.MQTT_RECONNECT_MIN_DELAY, self.MQTT_RECONNECT_MAX_DELAY)
         
         try:
-            self.mqtt_client.connect(self.MQTT_BROKER, self.MQTT_PORT, 60)
+            self.mqtt_client.connect_async(self.MQTT_BROKER, self.MQTT_PORT, 60)
             self.mqtt_client.loop_start()
-            self._log("MQTT client connected successfully")
+            self._log("MQTT client started")
         except Exception as e:
             self._log(f"MQTT connection failed: {e}")
+        
+        self._publisher_thread = threading.Thread(target=self._publisher, daemon=True)
+        self._publisher_thread.start()
     
     def _publish_mqtt(self, device_id: str, data: Dict):
-        """Publish data to MQTT broker for Home Assistant."""
+        """Queue data for publishing to MQTT broker for Home Assistant."""
         if not self.mqtt_client:
             return
         
+        topic = self._topic_cache.get(device_id)
+        if topic is None:
+            topic = self._topic_cache[device_id] = f"{self.MQTT_TOPIC_PREFIX}/{device_id}/state"
+        
+        item = (topic, _dumps(data))
         try:
-            # Publish full state data
-            topic = f"{self.MQTT_TOPIC_PREFIX}/{device_id}/state"
-            payload = json.dumps(data)
-            self.mqtt_client.publish(topic, payload, retain=True)
-            self._log(f"Published to MQTT: {topic}")
-        except Exception as e:
-            self._log(f"MQTT publish error: {e}")
+            self._pub_q.put_nowait(item)
+        except queue.Full:
+            # State topics are retained, so keep the freshest message and
+            # drop the oldest one instead
+            try:
+                self._pub_q.get_nowait()
+            except queue.Empty:
+                pass
+            self._log("MQTT publish queue full. Dropping oldest message.")
+            self._pub_q.put_nowait(item)
+    
+    def _publisher(self):
+        """Publish queued messages so socket handling never waits on the broker."""
+        while True:
+            item = self._pub_q.get()
+            if item is None:
+                break
+            
+            topic, payload = item
+            try:
+                # Publish full state data
+                self.mqtt_client.publish(topic, payload, qos=0, retain=True)
+                if self.verbose:
+                    self._log(f"Published to MQTT: {topic}")
+            except Exception as e:
+                self._log(f"MQTT publish error: {e}")
     
     def _log(self, message: str):
         """Print timestamped log message."""
         if self.verbose:
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}")
     
     def start_server(self):
-        """Start the server to listen for connections."""
+        """Start the server and run the event loop for all connections."""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Set before listen() so accepted sockets inherit them and the TCP
+        # window scale is negotiated accordingly
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_RCVBUF)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCKET_SNDBUF)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
+        self.server_socket.setblocking(False)
+        
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
         self.running = True
         
         print(f"Server listening on {self.host}:{self.port}")
         
         try:
             while self.running:
-                client_socket, client_address = self.server_socket.accept()
-                self._log(f"New connection from: {client_address}")
-                
-                thread = threading.Thread(
-                    target=self._handle_client,
-                    args=(client_socket, client_address),
-                    daemon=True
-                )
-                thread.start()
+                for key, events in self.selector.select(timeout=1.0):
+                    if key.data is None:
+                        self._accept_client()
+                        continue
+                    
+                    if events & selectors.EVENT_WRITE and not self._flush_client(key.fileobj, key.data):
+                        continue
+                    if events & selectors.EVENT_READ:
+                        self._handle_client(key.fileobj, key.data)
         except Exception as e:
             self._log(f"Server error: {e}")
         finally:
             self.stop_server()
     
-    def _handle_client(self, client_socket: socket.socket, client_address: Tuple):
-        """Handle all communication with a connected client."""
-        device_imei = None
+    def _accept_client(self):
+        """Accept a new connection and register it with the selector."""
+        try:
+            client_socket, client_address = self.server_socket.accept()
+        except BlockingIOError:
+            return
+        
+        self._log(f"New connection from: {client_address}")
+        
+        client_socket.setblocking(False)
+        # ACKs are tiny; don't let Nagle hold them back
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if _TCP_QUICKACK is not None:
+            client_socket.setsockopt(socket.IPPROTO_TCP, _TCP_QUICKACK, 1)
+        
+        # Persistent receive buffer; records split across reads stay in it
+        # until the rest arrives
+        buf = bytearray(self.RECV_BUFFER_SIZE)
+        client = {
+            "address": client_address,
+            "buf": buf,
+            "view": memoryview(buf),
+            "write_pos": 0,
+            "outbuf": bytearray(),
+            "events": selectors.EVENT_READ,
+            "imei": None,
+        }
+        self.selector.register(client_socket, selectors.EVENT_READ, client)
+    
+    def _handle_client(self, client_socket: socket.socket, client: Dict):
+        """Read available data from a client and process complete packets."""
+        client_address = client["address"]
+        buf = client["buf"]
+        view = client["view"]
+        write_pos = client["write_pos"]
         
         try:
-            while self.running:
-                data = client_socket.recv(1024)
-                if not data:
-                    self._log(f"Connection closed by {client_address}")
-                    break
-                
-                self._log(f"Received from {client_address}: {data.hex()}")
-                device_imei = self._process_packet(client_socket, data, device_imei)
-                
+            received = client_socket.recv_into(view[write_pos:])
+        except BlockingIOError:
+            return
         except Exception as e:
             self._log(f"Error handling client {client_address}: {e}")
-        finally:
-            client_socket.close()
-            self._log(f"Disconnected from {client_address}")
-    
-    def _process_packet(self, client_socket: socket.socket, packet: bytes, device_imei: Optional[str]) -> Optional[str]:
-        """Process packet and return device IMEI if available."""
-        if len(packet) < 9 or packet[0] != self.HEADER_MARK1 or packet[1] != self.HEADER_MARK2:
-            self._log("Invalid packet header or too short. Discarding.")
-            return device_imei
+            self._close_client(client_socket, client)
+            return
         
-        cmd = packet[2]
+        if not received:
+            self._log(f"Connection closed by {client_address}")
+            self._close_client(client_socket, client)
+            return
+        
+        if _TCP_QUICKACK is not None:
+            client_socket.setsockopt(socket.IPPROTO_TCP, _TCP_QUICKACK, 1)
+        
+        if self.verbose:
+            self._log(f"Received from {client_address}: {view[write_pos:write_pos + received].hex()}")
+        write_pos += received
         
         try:
-            if cmd == self.CMD_LOGIN:
-                return self._handle_login(client_socket, packet)
-            elif cmd == self.CMD_HEARTBEAT:
-                self._handle_heartbeat(client_socket, packet, device_imei)
-            elif cmd == self.CMD_LOCATION:
-                self._handle_location(client_socket, packet, device_imei)
-            else:
-                self._log(f"Unsupported command 0x{cmd:02x}. Sending generic ACK.")
-                self._send_ack(client_socket, packet)
+            consumed = self._process_packet(view[:write_pos], client)
         except Exception as e:
-            self._log(f"Error processing packet: {e}")
+            self._log(f"Error handling client {client_address}: {e}")
+            self._close_client(client_socket, client)
+            return
         
-        return device_imei
+        if consumed:
+            buf[:write_pos - consumed] = buf[consumed:write_pos]
+            write_pos -= consumed
+        
+        if write_pos == len(buf):
+            self._log("Receive buffer full without a complete packet. Discarding.")
+            write_pos = 0
+        
+        client["write_pos"] = write_pos
+        
+        # Acknowledge everything handled in this pass with a single send
+        if client["outbuf"]:
+            self._flush_client(client_socket, client)
     
-    def _handle_login(self, client_socket: socket.socket, packet: bytes) -> str:
-        """Handle device login packet."""
+    def _flush_client(self, client_socket: socket.socket, client: Dict) -> bool:
+        """Send as much pending output as the socket accepts.
+        
+        Whatever the socket does not take stays buffered and the client is
+        watched for writability until it drains. Returns False if the
+        client had to be closed.
+        """
+        outbuf = client["outbuf"]
+        try:
+            sent = client_socket.send(outbuf)
+        except BlockingIOError:
+            sent = 0
+        except Exception as e:
+            self._log(f"Error sending to client {client['address']}: {e}")
+            self._close_client(client_socket, client)
+            return False
+        
+        del outbuf[:sent]
+        
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if outbuf else selectors.EVENT_READ
+        if events != client["events"]:
+            self.selector.modify(client_socket, events, client)
+            client["events"] = events
+        return True
+    
+    def _close_client(self, client_socket: socket.socket, client: Dict):
+        """Unregister and close a client connection."""
+        self.selector.unregister(client_socket)
+        client["view"].release()
+        client_socket.close()
+        self._log(f"Disconnected from {client['address']}")
+    
+    def _process_packet(self, data: memoryview, client: Dict) -> int:
+        """Process all complete packets in data and return the number of bytes consumed.
+        
+        ACKs are appended to the client's output buffer for the caller to send.
+        """
+        offset = 0
+        acks = client["outbuf"]
+        
+        # Each packet is a 5-byte header (marks, cmd, size) followed by size bytes
+        while len(data) - offset >= 5:
+            marks, cmd, size = _HEADER_S.unpack_from(data, offset)
+            # A size that can never fit in the receive buffer means we are
+            # not looking at a real header either
+            if marks != self.HEADER_MARKS or size > self.RECV_BUFFER_SIZE - 5:
+                # Resync on the next header marks instead of dropping the buffer
+                next_start = bytes(data[offset + 1:]).find(self.HEADER_MARKS_BYTES)
+                if next_start >= 0:
+                    skipped = next_start + 1
+                elif data[-1] == self.HEADER_MARK1:
+                    # The last byte may be the first half of the next header
+                    skipped = len(data) - 1 - offset
+                else:
+                    skipped = len(data) - offset
+                self._log(f"Invalid packet header. Skipping {skipped} bytes.")
+                offset += skipped
+                continue
+            
+            packet_end = offset + 5 + size
+            if packet_end > len(data):
+                break
+            
+            packet = data[offset:packet_end]
+            offset = packet_end
+            
+            # Every packet carries at least seq (2 bytes) plus 2 bytes of data
+            if size < 4:
+                self._log("Packet too short. Discarding.")
+                continue
+            
+            handler = self._handlers.get(cmd)
+            
+            try:
+                if handler:
+                    client["imei"] = handler(acks, packet, client["imei"])
+                else:
+                    if self.verbose:
+                        self._log(f"Unsupported command 0x{cmd:02x}. Sending generic ACK.")
+                    self._send_ack(acks, packet)
+            except Exception as e:
+                self._log(f"Error processing packet: {e}")
+        
+        return offset
+    
+    def _handle_login(self, acks: bytearray, packet: bytes, device_imei: Optional[str]) -> Optional[str]:
+        """Handle device login packet and return the logged-in device IMEI."""
         self._log("Handling LOGIN packet")
         
         if len(packet) < 20:
             self._log("Login packet too short")
             return None
         
-        imei = hex(int.from_bytes(packet[7:15], 'big'))[2:]
+        imei = packet[7:15].hex().lstrip('0') or '0'
         seq = int.from_bytes(packet[5:7], 'big')
         
-        self._log(f"Device IMEI: {imei}, Seq: {seq}")
+        if self.verbose:
+            self._log(f"Device IMEI: {imei}, Seq: {seq}")
         
-        response = struct.pack(
-            '>BBBHHIHB',
+        response = _LOGIN_ACK_S.pack(
             self.HEADER_MARK1, self.HEADER_MARK2,
             self.CMD_LOGIN,
             9,  # size
@@ -160,205 +452,149 @@ class EelinkV2Server:
             0   # ps_action
         )
         
-        client_socket.send(response)
-        self._log(f"LOGIN ACK sent: {response.hex()}")
+        acks += response
+        if self.verbose:
+            self._log(f"LOGIN ACK queued: {response.hex()}")
         
-        return str(imei)
+        return imei
     
-    def _handle_heartbeat(self, client_socket: socket.socket, packet: bytes, device_imei: Optional[str]):
+    def _handle_heartbeat(self, acks: bytearray, packet: bytes, device_imei: Optional[str]) -> Optional[str]:
         """Handle heartbeat packet."""
         self._log("Handling HEARTBEAT packet")
         
         seq = int.from_bytes(packet[5:7], 'big')
         status = int.from_bytes(packet[7:9], 'big')
         
-        self._log(f"Seq: {seq}, Status: 0x{status:04X}")
+        if self.verbose:
+            self._log(f"Seq: {seq}, Status: 0x{status:04X}")
         self._parse_status(status)
         
         if device_imei:
             self._publish_mqtt(device_imei, {
                 "status": status,
-                "heartbeat_time":  datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                "heartbeat_time": time.strftime("%Y-%m-%d %H:%M:%S")
             })
         
-        response = struct.pack('>BBBHH', self.HEADER_MARK1, self.HEADER_MARK2, self.CMD_HEARTBEAT, 2, seq)
-        client_socket.send(response)
-        self._log(f"HEARTBEAT ACK sent: {response.hex()}")
+        self._send_ack(acks, packet, "HEARTBEAT")
+        
+        return device_imei
 
-    def _handle_location(self, client_socket: socket.socket, packet: bytes, device_imei: Optional[str]):
+    def _handle_location(self, acks: bytearray, packet: bytes, device_imei: Optional[str]) -> Optional[str]:
         """Handle GPS location data packet."""
         self._log("Handling LOCATION DATA packet")
         
-        chunks = [packet[i:i+74] for i in range(0, len(packet), 74)]
+        seq = _U16_S.unpack_from(packet, 5)[0]
+        data_section = packet[7:]
         
-        for chunk in chunks:
-            seq = int.from_bytes(chunk[5:7], 'big')
-            data_section = chunk[7:]
-            
-            position, offset = self._parse_position(data_section)
-            
-            # Parse additional data
-            status = int.from_bytes(data_section[offset:offset+2], 'big')
-            battery = int.from_bytes(data_section[offset+2:offset+4], 'big') / 1000.0
-            ain0 = int.from_bytes(data_section[offset+4:offset+6], 'big')
-            ain1 = int.from_bytes(data_section[offset+6:offset+8], 'big')
-            mileage = int.from_bytes(data_section[offset+8:offset+12], 'big') / 1000.0
-            gsm_cntr = int.from_bytes(data_section[offset+12:offset+14], 'big')
-            gps_cntr = int.from_bytes(data_section[offset+14:offset+16], 'big')
-            pdm_step = int.from_bytes(data_section[offset+16:offset+18], 'big')
-            pdm_time = int.from_bytes(data_section[offset+18:offset+20], 'big')
-            temperature = int.from_bytes(data_section[offset+20:offset+22], 'big') / 256.0
-            humidity = int.from_bytes(data_section[offset+22:offset+24], 'big')
-            illuminance = int.from_bytes(data_section[offset+24:offset+28], 'big')
-            co2 = int.from_bytes(data_section[offset+28:offset+32], 'big')
-            
-            # Log data
+        position, offset = self._parse_position(data_section)
+        
+        # Parse additional data
+        (status, battery_raw, ain0, ain1, mileage_raw, gsm_cntr, gps_cntr,
+         pdm_step, pdm_time, temp_raw, humidity, illuminance, co2) = _TAIL_S.unpack_from(data_section, offset)
+        battery = battery_raw / 1000.0
+        mileage = mileage_raw / 1000.0
+        temperature = temp_raw * _TEMP_SCALE
+        
+        # Log data
+        if self.verbose:
             self._log(f"Seq: {seq}")
             self._log(f"Date: {position.get('date')}")
             self._log(f"Location: {position.get('latitude')}, {position.get('longitude')}")
             self._log(f"Altitude: {position.get('altitude_m')} m, Speed: {position.get('speed_kmh')} km/h")
             self._log(f"Battery: {battery} V, Temperature: {temperature} °C")
-            self._parse_status(status)
+        self._parse_status(status)
 
-            # Publish to MQTT
-            if device_imei:
-                mqtt_data = {
-                    "gpsfix_time": position.get('date'),
-                    "latitude": position.get('latitude'),
-                    "longitude": position.get('longitude'),
-                    "altitude": position.get('altitude_m'),
-                    "speed": position.get('speed_kmh'),
-                    "course": position.get('course_deg'),
-                    "satellites": position.get('satellites'),
-                    "battery": battery,
-                    "temperature": temperature,
-                    "humidity": humidity,
-                    "illuminance": illuminance,
-                    "co2": co2,
-                    "mileage": mileage,
-                    "steps": pdm_step,
-                    "status": status,
-                    "ain0": ain0,
-                    "ain1": ain1,
-                    "cell_info": position.get('bsid0')
-                }
-                self._publish_mqtt(device_imei, mqtt_data)
-            
-            # Send ACK
-            response = struct.pack('>BBBHH', self.HEADER_MARK1, self.HEADER_MARK2, self.CMD_LOCATION, 2, seq)
-            client_socket.send(response)
-            self._log(f"LOCATION ACK sent: {response.hex()}")
+        # Publish to MQTT
+        if device_imei:
+            mqtt_data = {
+                "gpsfix_time": position.get('date'),
+                "latitude": position.get('latitude'),
+                "longitude": position.get('longitude'),
+                "altitude": position.get('altitude_m'),
+                "speed": position.get('speed_kmh'),
+                "course": position.get('course_deg'),
+                "satellites": position.get('satellites'),
+                "battery": battery,
+                "temperature": temperature,
+                "humidity": humidity,
+                "illuminance": illuminance,
+                "co2": co2,
+                "mileage": mileage,
+                "steps": pdm_step,
+                "status": status,
+                "ain0": ain0,
+                "ain1": ain1,
+                "cell_info": position.get('bsid0')
+            }
+            self._publish_mqtt(device_imei, mqtt_data)
+        
+        # Send ACK
+        self._send_ack(acks, packet, "LOCATION")
+        if self.verbose:
             self._log("-" * 50)
-    
+        
+        return device_imei
+
     def _parse_position(self, data: bytes) -> Tuple[Dict, int]:
         """Parse POSITION structure from bytes."""
-        offset = 0
-        position = {}
-        
-        # Time (4 bytes)
-        timestamp = struct.unpack_from(">I", data, offset)[0]
-        offset += 4
-        position["time"] = timestamp
-        position["date"] = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Mask (1 byte)
-        mask = struct.unpack_from(">B", data, offset)[0]
-        offset += 1
-        
-        # GPS data (bit 0)
-        if mask & 0x01:
-            lat, lon, alt, speed, course, sats = struct.unpack_from(">iiHHHB", data, offset)
-            offset += 15
-            position["latitude"] = lat / (162000000 / 90.0)
-            position["longitude"] = lon / (324000000 / 180.0)
-            position["altitude_m"] = struct.unpack(">h", struct.pack(">H", alt))[0]
-            position["speed_kmh"] = speed
-            position["course_deg"] = course
-            position["satellites"] = sats
-        
-        # BSID0 (bit 1)
-        if mask & 0x02:
-            mcc, mnc, lac, cid, rxlev = struct.unpack_from(">HHHIB", data, offset)
-            offset += 11
-            position["bsid0"] = {"mcc": mcc, "mnc": mnc, "lac": lac, "cid": cid, "rxlev": rxlev}
-        
-        # BSID1 (bit 2)
-        if mask & 0x04:
-            lac, ci, rxlev = struct.unpack_from(">HIB", data, offset)
-            offset += 7
-            position["bsid1"] = {"lac": lac, "ci": ci, "rxlev": rxlev}
-        
-        # BSID2 (bit 3)
-        if mask & 0x08:
-            lac, ci, rxlev = struct.unpack_from(">HIB", data, offset)
-            offset += 7
-            position["bsid2"] = {"lac": lac, "ci": ci, "rxlev": rxlev}
-        
-        # BSS0 (bit 4)
-        if mask & 0x10:
-            bssid = data[offset:offset+6]
-            rssi = struct.unpack_from(">b", data, offset+6)[0]
-            offset += 7
-            position["bss0"] = {"bssid": ":".join(f"{b:02x}" for b in bssid), "rssi": rssi}
-        
-        # BSS1 (bit 5)
-        if mask & 0x20:
-            bssid = data[offset:offset+6]
-            rssi = struct.unpack_from(">b", data, offset+6)[0]
-            offset += 7
-            position["bss1"] = {"bssid": ":".join(f"{b:02x}" for b in bssid), "rssi": rssi}
-        
-        # BSS2 (bit 6)
-        if mask & 0x40:
-            bssid = data[offset:offset+6]
-            rssi = struct.unpack_from(">b", data, offset+6)[0]
-            offset += 7
-            position["bss2"] = {"bssid": ":".join(f"{b:02x}" for b in bssid), "rssi": rssi}
-        
-        return position, offset
+        # Time (4 bytes) and mask (1 byte), followed by the sections flagged
+        # in the mask; trackers keep sending the same mask, so the parser
+        # generated for it is cached
+        mask = data[4]
+        parser = self._parsers.get(mask)
+        if parser is None:
+            parser = self._parsers[mask] = _compile_position_parser(mask, self._format_date)
+        return parser(data)
+    
+    def _format_date(self, timestamp: int) -> str:
+        """Format a GPS timestamp as local time."""
+        # Records in a burst often share the same second; reuse the last date
+        if timestamp != self._last_ts:
+            self._last_date = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+            self._last_ts = timestamp
+        return self._last_date
     
     def _parse_status(self, status: int):
         """Parse and log device status bits."""
-        status &= 0xFFFF
+        if not self.verbose:
+            return
         
-        status_bits = {
-            0: ("GPS fixed", "GPS NOT fixed"),
-            1: ("Car device", "NOT car device"),
-            2: ("Engine fired", "Engine NOT fired"),
-            3: ("Accelerometer supported", "No accelerometer"),
-            4: ("Motion-warning active", "Motion-warning inactive"),
-            5: ("Relay control supported", "No relay control"),
-            6: ("Relay triggered", "Relay NOT triggered"),
-            7: ("External charging supported", "No external charging"),
-            8: ("Charging", "NOT charging"),
-            9: ("Device active", "Device stationary"),
-            10: ("GPS module running", "GPS module NOT running"),
-            11: ("OBD module running", "OBD module NOT running"),
-            12: ("DIN0 HIGH", "DIN0 LOW"),
-            13: ("DIN1 HIGH", "DIN1 LOW"),
-            14: ("DIN2 HIGH", "DIN2 LOW"),
-            15: ("DIN3 HIGH", "DIN3 LOW"),
-        }
+        status &= 0xFFFF
         
-        self._log(f"Device status: 0x{status:04X}")
-        for bit, (high_msg, low_msg) in status_bits.items():
-            msg = high_msg if status & (1 << bit) else low_msg
-            self._log(f"  Bit {bit}: {msg}")
+        # pair[0] when the bit is set, pair[1] when it is cleared
+        self._log(f"Device status: 0x{status:04X}\n" + "\n".join(
+            f"  Bit {bit}: {pair[not (status >> bit) & 1]}"
+            for bit, pair in enumerate(self._STATUS_PAIRS)
+        ))
     
-    def _send_ack(self, client_socket: socket.socket, packet: bytes):
-        """Send generic acknowledgment."""
-        seq = int.from_bytes(packet[5:7], 'big')
-        response = struct.pack('>BBBHH', self.HEADER_MARK1, self.HEADER_MARK2, packet[2], 2, seq)
-        client_socket.send(response)
-        self._log(f"Generic ACK sent: {response.hex()}")
+    def _send_ack(self, acks: bytearray, packet: bytes, label: str = "Generic"):
+        """Queue a standard acknowledgment echoing the packet's command and sequence."""
+        pos = len(acks)
+        acks += self.ACK_TEMPLATE
+        acks[pos + 2] = packet[2]
+        acks[pos + 5:pos + 7] = packet[5:7]
+        if self.verbose:
+            self._log(f"{label} ACK queued: {acks[pos:].hex()}")
     
     def stop_server(self):
         """Stop the server gracefully."""
         self.running = False
         
         if self.mqtt_client:
-            self.mqtt_client.loop_stop()
+            # Let the publisher hand everything still queued to paho first
+            if self._publisher_thread and self._publisher_thread.is_alive():
+                self._pub_q.put(None)
+                self._publisher_thread.join(self.MQTT_STOP_TIMEOUT)
             self.mqtt_client.disconnect()
+            self.mqtt_client.loop_stop()
+            self.mqtt_client = None
+        
+        if self.selector:
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None:
+                    self._close_client(key.fileobj, key.data)
+            self.selector.close()
+            self.selector = None
         
         if self.server_socket:
             self.server_socket.close()